@@ -1,10 +1,16 @@
+import asyncio
+import io
 import os
 import logging
 import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import Dict, Optional
-import requests
+from typing import Dict, List, Optional, Set, Tuple
+import aiohttp
+import orjson
 import pytz
+from cachetools import TTLCache
 import google.generativeai as genai
 from gtts import gTTS
 
@@ -12,6 +18,7 @@ from telegram import Update, ReplyKeyboardMarkup, KeyboardButton
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
+from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
 from dotenv import load_dotenv
 
 
@@ -39,65 +46,163 @@ generation_config = {
 }
 model = genai.GenerativeModel('gemini-1.5-flash', generation_config=generation_config)
 
+PROMPT_TEMPLATE = """
+Напиши креативний прогноз погоди згідно з цими даними:
+{}
+Використовуй емодзі, жартівливий стиль та корисні поради.
+"""
+
+# Кеш згенерованих описів для схожих погодних умов (15 хвилин)
+description_cache = TTLCache(maxsize=512, ttl=900)
+
 # Ініціалізація бази даних
+DB = sqlite3.connect('weather_bot.db', check_same_thread=False)
+db_lock = threading.RLock()
+
+# Налаштування всіх користувачів у пам'яті, щоб не звертатися до БД на кожне оновлення
+USER_SETTINGS: Dict[int, Dict] = {}
+
 def init_db():
-    conn = sqlite3.connect('weather_bot.db')
-    c = conn.cursor()
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            user_id INTEGER PRIMARY KEY,
-            latitude REAL,
-            longitude REAL,
-            notification_time TEXT,
-            timezone TEXT
-        )
-    ''')
-    conn.commit()
-    conn.close()
+    with db_lock, DB:
+        DB.execute('PRAGMA journal_mode=WAL')
+        DB.execute('PRAGMA synchronous=NORMAL')
+        DB.execute('''
+            CREATE TABLE IF NOT EXISTS users (
+                user_id INTEGER PRIMARY KEY,
+                latitude REAL,
+                longitude REAL,
+                notification_time TEXT,
+                timezone TEXT
+            )
+        ''')
+        DB.execute('''
+            CREATE TABLE IF NOT EXISTS tz_cache (
+                lat_r REAL,
+                lon_r REAL,
+                zone TEXT,
+                PRIMARY KEY (lat_r, lon_r)
+            )
+        ''')
+        rows = DB.execute('SELECT user_id, latitude, longitude, notification_time, timezone FROM users')
+        for user_id, lat, lon, notification_time, timezone in rows:
+            USER_SETTINGS[user_id] = {
+                'latitude': lat,
+                'longitude': lon,
+                'notification_time': notification_time,
+                'timezone': timezone
+            }
 
 init_db()
 
+# Кеш часових поясів за округленими координатами
+tz_cache: Dict[Tuple[float, float], str] = {}
+
+# Спільна HTTP-сесія, створюється в setup_scheduler
+http_session: Optional[aiohttp.ClientSession] = None
+HTTP_TIMEOUT = aiohttp.ClientTimeout(total=10)
+
+db_writer_task: Optional[asyncio.Task] = None
+
+UPSERT_USER_SQL = '''
+    INSERT INTO users (user_id, latitude, longitude, notification_time, timezone)
+    VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT(user_id) DO UPDATE SET
+        latitude = COALESCE(excluded.latitude, latitude),
+        longitude = COALESCE(excluded.longitude, longitude),
+        notification_time = COALESCE(excluded.notification_time, notification_time),
+        timezone = COALESCE(excluded.timezone, timezone)
+'''
+
+# Черга записів у БД, яку розбирає db_writer пачками в одній транзакції
+write_queue: asyncio.Queue = asyncio.Queue()
+
+def write_user_settings(rows: List[Tuple]):
+    with db_lock, DB:
+        DB.executemany(UPSERT_USER_SQL, rows)
+
+async def db_writer(batch_size: int = 100, retry_delay: float = 1.0):
+    rows = []
+    try:
+        while True:
+            if not rows:
+                rows.append(await write_queue.get())
+            try:
+                while len(rows) < batch_size:
+                    rows.append(await asyncio.wait_for(write_queue.get(), 0.05))
+            except asyncio.TimeoutError:
+                pass
+            try:
+                write_user_settings(rows)
+                rows = []
+            except Exception as e:
+                # USER_SETTINGS вже містить нові значення, тому пачку не відкидаємо, а повторюємо
+                logging.error(f"Помилка запису налаштувань, повтор через {retry_delay} с: {str(e)}")
+                await asyncio.sleep(retry_delay)
+    finally:
+        # Записуємо незбережену пачку навіть якщо задачу скасовано під час зупинки
+        if rows:
+            try:
+                write_user_settings(rows)
+            except Exception as e:
+                logging.error(f"Помилка запису налаштувань: {str(e)}")
+
+def flush_user_settings():
+    rows = []
+    while not write_queue.empty():
+        rows.append(write_queue.get_nowait())
+    if rows:
+        write_user_settings(rows)
+
 def save_user_settings(user_id: int, lat: float = None, lon: float = None, 
                     notification_time: str = None, timezone: str = None):
-    conn = sqlite3.connect('weather_bot.db')
-    c = conn.cursor()
-    
-    current = get_user_settings(user_id)
-    new_lat = lat if lat is not None else current.get('latitude')
-    new_lon = lon if lon is not None else current.get('longitude')
-    new_time = notification_time if notification_time is not None else current.get('notification_time')
-    new_tz = timezone if timezone is not None else current.get('timezone')
-    
-    c.execute('''
-        INSERT OR REPLACE INTO users 
-        (user_id, latitude, longitude, notification_time, timezone)
-        VALUES (?, ?, ?, ?, ?)
-    ''', (user_id, new_lat, new_lon, new_time, new_tz))
-    
-    conn.commit()
-    conn.close()
+    with db_lock:
+        settings = USER_SETTINGS.setdefault(user_id, {
+            'latitude': None,
+            'longitude': None,
+            'notification_time': None,
+            'timezone': None
+        })
+        for field, value in (('latitude', lat), ('longitude', lon),
+                             ('notification_time', notification_time), ('timezone', timezone)):
+            if value is not None:
+                settings[field] = value
+
+    write_queue.put_nowait((user_id, lat, lon, notification_time, timezone))
 
 def get_user_settings(user_id: int) -> Dict:
-    conn = sqlite3.connect('weather_bot.db')
-    c = conn.cursor()
-    c.execute('SELECT latitude, longitude, notification_time, timezone FROM users WHERE user_id = ?', (user_id,))
-    result = c.fetchone()
-    conn.close()
-    if result:
-        return {
-            'latitude': result[0],
-            'longitude': result[1],
-            'notification_time': result[2],
-            'timezone': result[3]
-        }
-    return {}
-
-def get_timezone(lat: float, lon: float) -> str:
+    return dict(USER_SETTINGS.get(user_id, {}))
+
+async def fetch_json(url: str, retries: int = 2) -> Dict:
+    # Повторюємо лише обірвані з'єднання та таймаути, сесія тримає з'єднання відкритими
+    for attempt in range(retries + 1):
+        try:
+            async with http_session.get(url, timeout=HTTP_TIMEOUT) as response:
+                response.raise_for_status()
+                return orjson.loads(await response.read())
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+            if attempt == retries:
+                raise
+            await asyncio.sleep(0.2 * 2 ** attempt)
+
+async def get_timezone(lat: float, lon: float) -> str:
+    key = (round(lat, 1), round(lon, 1))
+    if key in tz_cache:
+        return tz_cache[key]
     try:
-        url = f"http://api.timezonedb.com/v2.1/get-time-zone?key={TIMEZONEDB_API_KEY}&format=json&by=position&lat={lat}&lng={lon}"
-        response = requests.get(url, timeout=10)
-        data = response.json()
-        return data.get('zoneName', 'Europe/Kiev')
+        with db_lock:
+            row = DB.execute('SELECT zone FROM tz_cache WHERE lat_r = ? AND lon_r = ?', key).fetchone()
+        if row:
+            zone = row[0]
+        else:
+            url = f"http://api.timezonedb.com/v2.1/get-time-zone?key={TIMEZONEDB_API_KEY}&format=json&by=position&lat={key[0]}&lng={key[1]}"
+            data = await fetch_json(url)
+            zone = data.get('zoneName')
+            if data.get('status') != 'OK' or not zone:
+                raise ValueError(data.get('message') or 'часовий пояс не знайдено')
+            with db_lock, DB:
+                DB.execute('INSERT OR REPLACE INTO tz_cache (lat_r, lon_r, zone) VALUES (?, ?, ?)', (*key, zone))
+        tz_cache[key] = zone
+        return zone
     except Exception as e:
         logging.error(f"Помилка отримання часового поясу: {str(e)}")
         return "Europe/Kiev"
@@ -105,74 +210,225 @@ def get_timezone(lat: float, lon: float) -> str:
 async def get_weather(lat: float, lon: float) -> Optional[Dict]:
     try:
         url = f"http://api.weatherapi.com/v1/current.json?key={WEATHERAPI_API_KEY}&q={lat},{lon}&lang=uk"
-        response = requests.get(url, timeout=10)
-        response.raise_for_status()
-        return response.json()
+        return await fetch_json(url)
     except Exception as e:
         logging.error(f"Помилка отримання погоди: {str(e)}")
         return None
 
+def weather_signature(weather_data: Dict) -> Tuple:
+    current = weather_data['current']
+    return (
+        round(current['temp_c']),
+        round(current['feelslike_c']),
+        current['condition']['text'],
+        round(current['wind_kph'] / 5) * 5,
+        round(current['humidity'] / 10) * 10,
+        round(current['uv']),
+        current['is_day'],
+    )
+
+def summarize_weather(signature: Tuple) -> str:
+    # Опис будується лише з ключа кешу, тож збережений текст підходить усім з тим самим ключем
+    temp, feelslike, condition, wind, humidity, uv, is_day = signature
+    return (
+        f"температура {temp}°C, відчувається як {feelslike}°C, {condition}, "
+        f"вітер близько {wind} км/год, вологість близько {humidity}%, "
+        f"УФ-індекс {uv}, {'день' if is_day else 'ніч'}"
+    )
+
 async def generate_weather_description(weather_data: Dict) -> str:
     try:
-        prompt = f"""
-        Напиши креативний прогноз погоди згідно з цими даними:
-        {weather_data}
-        Використовуй емодзі, жартівливий стиль та корисні поради.
-        """
-        response = model.generate_content(prompt)
+        signature = weather_signature(weather_data)
+        if signature in description_cache:
+            return description_cache[signature]
+
+        prompt = PROMPT_TEMPLATE.format(summarize_weather(signature))
+        response = await model.generate_content_async(prompt)
+        description_cache[signature] = response.text
         return response.text
     except Exception as e:
         logging.error(f"Помилка генерації опису: {str(e)}")
         return "🌤️ Прогноз погоди на сьогодні: гарна погода!"
 
-async def send_daily_weather(bot, user_id: int):
+def synthesize_speech(text: str) -> bytes:
+    audio = io.BytesIO()
+    gTTS(text=text, lang='uk').write_to_fp(audio)
+    return audio.getvalue()
+
+async def prepare_forecast(lat: float, lon: float) -> Optional[Tuple[str, bytes]]:
+    weather_data = await get_weather(lat, lon)
+    if not weather_data:
+        return None
+
+    description = await generate_weather_description(weather_data)
+    # gTTS робить синхронний HTTP-запит, тому виконуємо його в окремому потоці
+    audio_bytes = await asyncio.to_thread(synthesize_speech, description)
+    return description, audio_bytes
+
+async def send_forecast(bot, user_id: int, description: str, audio_bytes: bytes):
+    audio = io.BytesIO(audio_bytes)
+    audio.name = "weather.mp3"
+    await bot.send_message(
+        chat_id=user_id,
+        text=description
+    )
+    await bot.send_audio(
+        chat_id=user_id,
+        audio=audio
+    )
+
+async def send_daily_weather(bot, user_id: int, settings: Optional[Dict] = None):
     try:
-        settings = get_user_settings(user_id)
+        if settings is None:
+            settings = get_user_settings(user_id)
         if not settings.get('latitude') or not settings.get('longitude'):
             return
             
-        weather_data = await get_weather(settings['latitude'], settings['longitude'])
-        if not weather_data:
+        forecast = await prepare_forecast(settings['latitude'], settings['longitude'])
+        if not forecast:
             return
             
-        description = await generate_weather_description(weather_data)
-        tts = gTTS(text=description, lang='uk')
-        tts.save("weather.mp3")
-        
-        await bot.send_message(
-            chat_id=user_id,
-            text=description
-        )
-        await bot.send_audio(
-            chat_id=user_id,
-            audio=open("weather.mp3", "rb")
-        )
-        os.remove("weather.mp3")
+        await send_forecast(bot, user_id, *forecast)
         
     except Exception as e:
         logging.error(f"Помилка відправки прогнозу: {str(e)}")
 
-scheduler = AsyncIOScheduler()
+async def send_group_weather(key: Tuple):
+    # Група могла спорожніти, поки видалення її завдання ще в черзі
+    members = notification_groups.get(key)
+    if not members:
+        return
+
+    try:
+        lat, lon = key[0], key[1]
+        forecast = await prepare_forecast(lat, lon)
+        if not forecast:
+            return
+    except Exception as e:
+        logging.error(f"Помилка підготовки прогнозу: {str(e)}")
+        return
+
+    for user_id in list(members):
+        try:
+            await send_forecast(telegram_bot, user_id, *forecast)
+        except Exception as e:
+            logging.error(f"Помилка відправки прогнозу: {str(e)}")
+
+# Завдання зберігаються в jobs.db і переживають перезапуск бота
+scheduler = AsyncIOScheduler(jobstores={'default': SQLAlchemyJobStore(url='sqlite:///jobs.db')})
+
+# Бот не серіалізується, тому завдання беруть його звідси, а не з аргументів
+telegram_bot = None
+
+# Користувачі з однаковою клітинкою координат, поясом і часом отримують один спільний прогноз
+notification_groups: Dict[Tuple, Set[int]] = {}
+user_groups: Dict[int, Tuple] = {}
+
+def group_job_id(key: Tuple) -> str:
+    lat, lon, timezone, time_str = key
+    return f"group_{lat}_{lon}_{timezone}_{time_str}"
+
+def normalize_time(time_str: str) -> str:
+    hour, minute = map(int, time_str.split(':'))
+    return f"{hour:02d}:{minute:02d}"
+
+def group_key(settings: Dict) -> Optional[Tuple]:
+    lat, lon = settings.get('latitude'), settings.get('longitude')
+    time_str, timezone = settings.get('notification_time'), settings.get('timezone')
+    if lat is None or lon is None or not time_str or not timezone:
+        return None
+    return (round(lat, 2), round(lon, 2), timezone, normalize_time(time_str))
+
+def add_group_job(key: Tuple):
+    timezone, time_str = key[2], key[3]
+    hour, minute = map(int, time_str.split(':'))
+    scheduler.add_job(
+        send_group_weather,
+        trigger=CronTrigger(hour=hour, minute=minute, timezone=timezone),
+        args=[key],
+        id=group_job_id(key),
+        replace_existing=True
+    )
+
+def remove_group_job(key: Tuple):
+    if scheduler.get_job(group_job_id(key)):
+        scheduler.remove_job(group_job_id(key))
+
+# Сховище завдань пише в SQLite синхронно, тому зміни виконуються в окремому потоці.
+# Один потік зберігає порядок операцій таким, яким його задали обробники.
+job_store_executor = ThreadPoolExecutor(max_workers=1)
+
+def run_job_store(func, *args) -> asyncio.Future:
+    return asyncio.get_running_loop().run_in_executor(job_store_executor, func, *args)
+
+def leave_group(user_id: int) -> Optional[Tuple]:
+    # Повертає ключ групи, якщо після виходу користувача вона спорожніла
+    key = user_groups.pop(user_id, None)
+    if key is None:
+        return None
+    members = notification_groups.get(key, set())
+    members.discard(user_id)
+    if members:
+        return None
+    notification_groups.pop(key, None)
+    return key
+
+async def schedule_user(user_id: int):
+    key = group_key(get_user_settings(user_id))
+    if key is None or user_groups.get(user_id) == key:
+        return
+
+    # Групи в пам'яті оновлюються і операції ставляться в чергу без await між ними,
+    # щоб паралельні обробники не переставили додавання та видалення завдань
+    jobs = []
+    if key not in notification_groups:
+        notification_groups[key] = set()
+        jobs.append(run_job_store(add_group_job, key))
+
+    empty_key = leave_group(user_id)
+    if empty_key is not None:
+        jobs.append(run_job_store(remove_group_job, empty_key))
+    notification_groups[key].add(user_id)
+    user_groups[user_id] = key
+
+    await asyncio.gather(*jobs)
+
+def load_notification_groups():
+    for user_id, settings in USER_SETTINGS.items():
+        key = group_key(settings)
+        if key is not None:
+            notification_groups.setdefault(key, set()).add(user_id)
+            user_groups[user_id] = key
+
+def sync_group_jobs():
+    # Звіряємо збережені завдання з групами: зазвичай нічого не додається і не видаляється
+    job_ids = {job.id for job in scheduler.get_jobs()}
+    group_ids = {group_job_id(key): key for key in notification_groups}
+    for job_id in job_ids - group_ids.keys():
+        scheduler.remove_job(job_id)
+    for job_id in group_ids.keys() - job_ids:
+        add_group_job(group_ids[job_id])
 
 async def setup_scheduler(app: Application) -> None:
+    global http_session, db_writer_task, telegram_bot
+    http_session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=32, ttl_dns_cache=300))
+    db_writer_task = asyncio.create_task(db_writer())
+    telegram_bot = app.bot
+    load_notification_groups()
     scheduler.start()
-    restore_jobs(app.bot)
-
-def restore_jobs(bot):
-    conn = sqlite3.connect('weather_bot.db')
-    c = conn.cursor()
-    c.execute('SELECT user_id, notification_time, timezone FROM users WHERE notification_time IS NOT NULL')
-    for user_id, time_str, timezone in c.fetchall():
-        if time_str and timezone:
-            hour, minute = map(int, time_str.split(':'))
-            scheduler.add_job(
-                send_daily_weather,
-                trigger=CronTrigger(hour=hour, minute=minute, timezone=timezone),
-                args=[bot, user_id],
-                id=f"user_{user_id}",
-                replace_existing=True
-            )
-    conn.close()
+    sync_group_jobs()
+
+async def shutdown(app: Application) -> None:
+    if db_writer_task:
+        db_writer_task.cancel()
+        try:
+            await db_writer_task
+        except asyncio.CancelledError:
+            pass
+    flush_user_settings()
+    job_store_executor.shutdown(wait=True)
+    if http_session:
+        await http_session.close()
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     buttons = [
@@ -187,18 +443,17 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
 async def handle_instant_forecast(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.message.from_user.id
-    settings = get_user_settings(user_id)
+    settings = USER_SETTINGS.get(user_id, {})
 
     if settings.get('latitude') and settings.get('longitude'):
-        weather_text = await get_weather(settings['latitude'], settings['longitude'])
-        await send_daily_weather(context.bot, user_id)
+        await send_daily_weather(context.bot, user_id, settings)
     else:
         await update.message.reply_text("🔍 Спочатку відправте своє місцезнаходження, щоб отримати прогноз.")
 
 async def handle_location(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.message.from_user.id
     location = update.message.location
-    timezone = get_timezone(location.latitude, location.longitude)
+    timezone = await get_timezone(location.latitude, location.longitude)
     
     save_user_settings(
         user_id=user_id,
@@ -206,6 +461,12 @@ async def handle_location(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         lon=location.longitude,
         timezone=timezone
     )
+    try:
+        await schedule_user(user_id)
+    except Exception as e:
+        logging.error(f"Помилка: {str(e)}")
+        await update.message.reply_text("‼️ Сталася помилка")
+        return
     
     await update.message.reply_text(
         f"📍 Локацію збережено!\n"
@@ -219,26 +480,19 @@ async def handle_time_setup(update: Update, context: ContextTypes.DEFAULT_TYPE)
 async def handle_time_input(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.message.from_user.id
     try:
-        time_str = update.message.text
-        hour, minute = map(int, time_str.split(':'))
+        time_str = normalize_time(update.message.text)
         settings = get_user_settings(user_id)
         
         if not settings.get('timezone'):
             await update.message.reply_text("❌ Спочатку вкажіть локацію!")
             return
             
-        scheduler.add_job(
-            send_daily_weather,
-            trigger=CronTrigger(hour=hour, minute=minute, timezone=settings['timezone']),
-            args=[context.bot, user_id],
-            id=f"user_{user_id}",
-            replace_existing=True
-        )
+        # Запис у users лише ставиться в чергу, тож завдання може з'явитися раніше за рядок у БД.
+        # Розбіжність виправляють повтори в db_writer і sync_group_jobs під час запуску
         save_user_settings(user_id=user_id, notification_time=time_str)
+        await schedule_user(user_id)
         await update.message.reply_text(f"✅ Сповіщення встановлено на {time_str} вашого часу!")
         
-    except ValueError:
-        await update.message.reply_text("‼️ Невірний формат! Використовуйте HH:MM")
     except Exception as e:
         logging.error(f"Помилка: {str(e)}")
         await update.message.reply_text("‼️ Сталася помилка")
@@ -248,12 +502,13 @@ def main() -> None:
     application = Application.builder()\
         .token(os.getenv("TELEGRAM_BOT_TOKEN"))\
         .post_init(setup_scheduler)\
+        .post_shutdown(shutdown)\
         .build()
 
     application.add_handler(CommandHandler("start", start))
     application.add_handler(MessageHandler(filters.LOCATION, handle_location))
     application.add_handler(MessageHandler(filters.Text(["Налаштувати сповіщення ⏰"]), handle_time_setup))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND & filters.Regex(r'^\d{1,2}:\d{2}$'), handle_time_input))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND & filters.Regex(r'^([01]?\d|2[0-3]):[0-5]\d$'), handle_time_input))
     application.add_handler(MessageHandler(filters.Text(["Отримати прогноз зараз 🌤️"]), handle_instant_forecast))
     application.run_polling()
 